@@ -54,7 +54,7 @@ if args.topology is not None:
     else:
         args.topology = Topology(input_topology=args.topology)
     args.topology.singlify(args.topology_leaf)
-    n = len([ n for n in args.topology if n.is_leaf()])
+    n = sum(1 for n in args.topology.iter_leaves())
 else:
     if args.output_format == 'topology':
         raise ValueError('Output format can only be a topology if a topology is used as input.')
@@ -8,17 +8,200 @@
 ##############################################################################
 
 import sys
+from array import array
 from copy import deepcopy
-from random import shuffle, randint
+from random import shuffle, randint, Random
 from functools import reduce
-from tmap.tree import Tree, Tleaf, TreeIterator
-from tmap.utils import isindex, which, factorial, order
+from itertools import combinations
+from bisect import bisect_left, bisect_right
+from multiprocessing import Pool
+from tmap.tree import Tree, Tleaf, Trandom
+from tmap.utils import isindex, factorial, fenwick
+
+"""
+Type code of the array storing permutation elements: C int, i.e 4 bytes
+per element on supported platforms, enough for any practical tree size.
+"""
+_typecode = 'i'
+
+"""
+Size from which Lehmer codes are computed with a Fenwick tree in O(n log n).
+Below, sorted list primitives (bisect, del, pop) are O(n^2) but run in C
+and are faster.
+"""
+_fenwick_threshold = 1 << 15
+
+"""
+Size from which factoradic digits are converted by blocks of radices
+fitting in a machine word (_block_radix), to spend time in small integer
+arithmetic rather than in big integer arithmetic.
+"""
+_block_threshold = 768
+_block_radix = 1 << 62
+
+"""
+Size below which permutations are decoded with straight-line functions
+specialized for their number of elements. See _unrank_function().
+"""
+_unrank_threshold = 64
+_unrank_functions = {}
+
+def _lehmer_encode(elements):
+    """
+    Compute the id of a complete index @elements from its Lehmer code.
+    """
+    # The Lehmer digit of an element is the number of smaller elements
+    # not consumed yet.
+    n = len(elements)
+    if n < _fenwick_threshold:
+        # Rank of e in the sorted list of remaining elements.
+        remaining = list(range(n))
+        digits = []
+        for e in elements:
+            r = bisect_left(remaining, e)
+            digits.append(r)
+            del remaining[r]
+        return _horner(digits)
+    # Remaining elements are counted in a Fenwick tree.
+    # Tree operations are inlined, this is a hot loop.
+    remaining = fenwick(n)
+    digits = []
+    for e in elements:
+        # Count remaining elements smaller than e.
+        r = 0
+        j = e
+        while j:
+            r += remaining[j]
+            j &= j - 1
+        digits.append(r)
+        # Remove e.
+        j = e + 1
+        while j <= n:
+            remaining[j] -= 1
+            j += j & -j
+    return _horner(digits)
+
+def _horner(digits):
+    """
+    Evaluate factoradic @digits, most significant radix first.
+    """
+    # Digit i has radix n-i. Evaluate in Horner form, from the last digit,
+    # to multiply the big integer by small integers only.
+    n = len(digits)
+    ret = 0
+    if n < _block_threshold:
+        for i in range(n - 1, -1, -1):
+            ret = ret * (n - i) + digits[i]
+        return ret
+    # Evaluate blocks of digits fitting a machine word with small integers,
+    # then fold blocks into the big integer.
+    i = n
+    while i:
+        block = 0
+        radix = 1
+        while i and radix * (n - i + 1) < _block_radix:
+            i -= 1
+            block = block * (n - i) + digits[i]
+            radix *= n - i
+        ret = ret * radix + block
+    return ret
+
+def _factoradic(n, id):
+    """
+    Factoradic digits of @id for radices @n down to 1, most significant
+    radix first. Trailing null digits are not returned.
+    Return the digits and the remainder of @id after its n first digits.
+    """
+    digits = []
+    if n < _block_threshold:
+        for k in range(n, 0, -1):
+            if id == 0:
+                break
+            id, r = divmod(id, k)
+            digits.append(r)
+        return digits, id
+    # Divide the big integer by blocks of radices fitting a machine word,
+    # then split blocks into digits with small integers.
+    k = n
+    while k and id:
+        radix = k
+        j = k - 1
+        while j and radix * j < _block_radix:
+            radix *= j
+            j -= 1
+        id, block = divmod(id, radix)
+        for r in range(k, j, -1):
+            block, d = divmod(block, r)
+            digits.append(d)
+        k = j
+    return digits, id
+
+def _lehmer_decode(n, id):
+    """
+    Build the complete index of @n elements with Lehmer code given by @id.
+    Return the index and the remainder of @id after its n first digits.
+    """
+    if n < _unrank_threshold:
+        return _unrank_function(n)(id)
+    # Trailing null digits select remaining elements in increasing order.
+    digits, id = _factoradic(n, id)
+    # Each digit is the rank of the next element among the elements not
+    # consumed yet.
+    if n < _fenwick_threshold:
+        remaining = list(range(n))
+        return [ remaining.pop(r) for r in digits ] + remaining, id
+    # Remaining elements are counted in a Fenwick tree.
+    # Tree operations are inlined, this is a hot loop.
+    remaining = fenwick(n)
+    consumed = [False] * n
+    elements = []
+    top = 1 << n.bit_length()
+    for r in digits:
+        # Find the (r+1)-th remaining element.
+        e = 0
+        step = top
+        while step:
+            j = e + step
+            if j <= n and remaining[j] <= r:
+                e = j
+                r -= remaining[j]
+            step >>= 1
+        consumed[e] = True
+        elements.append(e)
+        # Remove it.
+        j = e + 1
+        while j <= n:
+            remaining[j] -= 1
+            j += j & -j
+    return elements + [ i for i in range(n) if not consumed[i] ], id
+
+def _unrank_function(n):
+    """
+    Get a version of _lehmer_decode() specialized for @n elements.
+    Loops are unrolled and radices are constants, which saves the
+    interpreter loop overhead on small permutations.
+    Functions are generated once per number of elements.
+    """
+    unrank = _unrank_functions.get(n)
+    if unrank is not None:
+        return unrank
+    code = [ 'def unrank(id):' ]
+    code += [ '    id, r{0} = divmod(id, {0})'.format(k) for k in range(n, 0, -1) ]
+    code += [ '    pop = list(range({})).pop'.format(n),
+              '    return [ {} ], id'.format(
+                  ', '.join('pop(r{})'.format(k) for k in range(n, 0, -1))) ]
+    namespace = {}
+    exec('\n'.join(code), namespace)
+    unrank = _unrank_functions[n] = namespace['unrank']
+    return unrank
 
 class Permutation:
     """
     Class representing a complete list of positive integers.
     """
 
+    __slots__ = ('elements', '_max_id', '_id_cache')
+
     def __init__(self, n: int, id=0):
         """
         Build a new permutation.
@@ -27,74 +210,121 @@ class Permutation:
           Else, the elements are permuted according to id. 
           Permutation(n, id).id() == id.
         * @n: A list [i:j:k:...] of a complete list of integer ,
-        if type(n) is list.
+        if type(n) is list or array.
+        Elements are stored in an array.array of machine integers.
         * @id: A big int representing the permutation id.
         * @id: A string "P\x1a\n+õûáö\x83ïo%&U\x8b[5´d" representing the permutation hash.
         """
 
         # Make sure id is an integer.
         if isinstance(id, str):
-            i = 0
-            for b in bytes(id, "latin1"):
-                i = i << 8
-                i = i | b
-            id = i
+            id = int.from_bytes(bytes(id, "latin1"), 'big')
         if not isinstance(id, int):
             raise ValueError("Expected 'int' of 'str' for id.")
-        
+
         if isinstance(n, int):
-            self.max_id = factorial(n)
-            id = id % self.max_id
-            elements = []
-            slots = [i for i in range(n)]
-            while id > 0 and len(slots) > 0:
-                s = id % len(slots)
-                id = (id - s) // len(slots)
-                elements.append(slots[s])
-                slots = [s for s in slots if s != elements[-1]]
-            self.elements = elements + slots
-            return
-        if isinstance(n, Permutation):
-            self.elements = n.elements.copy()
-            self.max_id = factorial(len(self.elements))
-            return
-        if isinstance(n, list):
+            self._init_int_(n, id)
+        elif isinstance(n, Permutation):
+            self._init_perm_(n)
+        elif isinstance(n, (list, array)):
             if not isindex(n):
                 raise ValueError(
                     'Permutation elements must be a complete index.')
-            self.elements = n
-            self.max_id = factorial(len(n))
+            self._init_list_(n)
         else:
             raise TypeError("""n must be either an index, a permutation string
-            or a number of elements.""")        
+            or a number of elements.""")
+
+    def _init_int_(self, n: int, id: int):
+        self._max_id = None
+        # Decoding consumes id digits modulo n!: only negative ids need
+        # to be wrapped explicitly.
+        if id < 0:
+            self._max_id = factorial(n)
+            id = id % self._max_id
+        self._id_cache = id
+        elements, id = _lehmer_decode(n, id)
+        self.elements = array(_typecode, elements)
+        # If digits remain, the input id was larger than max_id.
+        if id != 0:
+            self._id_cache = None
+
+    def _init_perm_(self, p):
+        self.elements = p.elements[:]
+        self._max_id = p._max_id
+        self._id_cache = p._id_cache
+
+    def _init_list_(self, l: list):
+        self.elements = array(_typecode, l)
+        self._max_id = None
+        self._id_cache = None
+
+    @classmethod
+    def _from_int(cls, n: int, id: int):
+        """
+        Build a permutation of @n elements from an integer @id,
+        without checking arguments type.
+        """
+        ret = cls.__new__(cls)
+        ret._init_int_(n, id)
+        return ret
+
+    @classmethod
+    def _from_perm(cls, p):
+        """
+        Build a copy of permutation @p without checking arguments type.
+        """
+        ret = cls.__new__(cls)
+        ret._init_perm_(p)
+        return ret
+
+    @classmethod
+    def _from_list(cls, l: list):
+        """
+        Build a permutation from a list of elements without checking
+        that @l is a complete index.
+        """
+        ret = cls.__new__(cls)
+        ret._init_list_(l)
+        return ret
+
+    @property
+    def max_id(self):
+        """
+        Number of permutations with as many elements as this permutation.
+        Computed on first access.
+        """
+        if self._max_id is None:
+            self._max_id = factorial(len(self.elements))
+        return self._max_id
 
     def id(self):
         """
         Permutation unique id as int.
         Permutation(n, id).id() == id.
+        The id is cached until the permutation is modified.
         """
 
-        ret = 0
-        mul = 1
-        elements = list(range(len(self.elements)))
-        for i in range(len(self.elements)):
-            j = which(elements, lambda x: x==self.elements[i])
-            ret += mul * j
-            mul *= len(elements)
-            elements = elements[:j] + elements[j + 1:]
-        return ret
+        if self._id_cache is not None:
+            return self._id_cache
+        self._id_cache = _lehmer_encode(self.elements)
+        return self._id_cache
 
     def __hash__(self):
         return self.id()
 
+    def __reduce__(self):
+        # Pickle permutations as their id rather than as their elements.
+        return (Permutation, (len(self), self.id()))
+
     def __iter__(self):
         return iter(self.elements)
 
     def copy(self):
         """
-        Deep copy of permutation.
+        Copy of permutation.
         """
-        return deepcopy(self)
+        return self._from_perm(self)
 
     def __getitem__(self, i: int) -> int:
         return self.elements[i]
@@ -103,16 +333,25 @@ class Permutation:
         return ':'.join([str(i) for i in self.elements])
 
     def __repr__(self) -> str:
-        return repr(self.elements)
+        return repr(self.elements.tolist())
 
     def __len__(self) -> int:
         return len(self.elements)
 
     def __eq__(self, other) -> bool:
+        if self is other:
+            return True
         if isinstance(other, list):
-            return self.elements == other
+            return len(self.elements) == len(other) and \
+                self.elements.tolist() == other
         if isinstance(other, Permutation):
+            if len(self.elements) != len(other.elements):
+                return False
+            # Ids are unique among permutations of the same length.
+            if self._id_cache is not None and other._id_cache is not None:
+                return self._id_cache == other._id_cache
             return self.elements == other.elements
+        return NotImplemented
 
     def __add__(self, p):
         """
@@ -122,15 +361,26 @@ class Permutation:
 
         if len(p) != len(self):
             raise ValueError('Cannot add permutations of different length.')
-        id_max = factorial(len(p))
-        new_id = (self.id() + p.id()) % id_max
-        return Permutation(len(self), new_id)
+        if p._is_identity_():
+            return Permutation._from_perm(self)
+        if self._is_identity_():
+            return Permutation._from_perm(p)
+        return Permutation._from_int(len(self), self.id() + p.id())
+
+    def _is_identity_(self) -> bool:
+        """
+        Return True if this permutation is the neutral element of addition.
+        """
+        if self._id_cache is not None:
+            return self._id_cache == 0
+        return self.elements == array(_typecode, range(len(self.elements)))
 
     def shuffle(self):
         """
         Shuffle permutation elements.
         """
         shuffle(self.elements)
+        self._id_cache = None
         return self
 
     def inverse(self):
@@ -138,7 +388,10 @@ class Permutation:
         Get the inverse permutation of this permutation.
         """
         ret = self.copy()
-        ret.elements = order(ret.elements)
+        # Position of each element.
+        for i, e in enumerate(self.elements):
+            ret.elements[e] = i
+        ret._id_cache = None
         return ret        
 
     @staticmethod
@@ -146,87 +399,158 @@ class Permutation:
         """
         Build a permutation that reorder src into dst.        
         """
-        return Permutation([ next(i for (i,s) in zip(range(len(src)), src) if s == d) for d in dst ])
+        pos = {}
+        for i, s in enumerate(src):
+            pos.setdefault(s, i)
+        return Permutation([ pos[d] for d in dst ])
 
 class TreePermutation(Permutation):
     """
     A Permutation mapped on a Tree where tree leaves are permutation elements.
     """            
+
+    __slots__ = ('tree', '_leaves', '_canonical')
+
     def __init__(self, tree_map: Tree, *args, **kwargs):
         """
         Build a Permutation with as many elements as @tree_map leaves.
         if @id > 0, initialize permutation elements with a permutation of same id.
         """
         self.tree = tree_map
-        n = TreeIterator(tree_map, lambda n: n.is_leaf()).count()
+        self._leaves = list(tree_map.iter_leaves())
+        n = len(self._leaves)
         if len(args) == 0 and len(kwargs.items()) == 0:
-            super().__init__(n)
+            self._init_int_(n, 0)
         else:
             super().__init__(*args, **kwargs)
         if len(self.elements) != n:
             raise ValueError("Non matching number of tree leaves and permutations length.")
         self._tag_()
         
+    def copy(self):
+        """
+        Copy of permutation and of its tree.
+        The tree is not shared because it holds the permutation tags and is
+        reordered by canonical() and shuffle_nodes().
+        """
+        ret = self._from_perm(self)
+        ret.tree = deepcopy(self.tree)
+        ret._leaves = None
+        ret._canonical = self._canonical
+        return ret
+
+    def __reduce__(self):
+        return (TreePermutation, (self.tree, len(self), self.id()))
+
+    def _leaves_(self):
+        """
+        Tree leaves in iteration order.
+        The list is cached and must be reset to None when tree nodes are swapped.
+        """
+        if self._leaves is None:
+            self._leaves = list(self.tree.iter_leaves())
+        return self._leaves
+
     def _tag_(self):        
-        ## Tag leaves
-        for e, n in zip(self.elements, TreeIterator(self.tree, Tree.is_leaf)):
-            n.permutation_index = e
-        ## Tag Nodes
-        TreePermutation._tag_nodes_(self.tree)
+        TreePermutation._tag_nodes_(self.tree, iter(self.elements), {})
+        self._canonical = None
 
     @staticmethod
-    def _tag_nodes_(node):
+    def _tag_nodes_(node, elements, shapes):
         """
-        Tag each node with the leaf having the smallest index.
+        Tag leaves with the next items of @elements iterator, in iteration
+        order, and each node with the leaf having the smallest index.
+        Group children with the same shape, i.e children which can be swapped.
+        @shapes maps a tuple of children shapes to a shape identifier.
+        Return the shape identifier of node.
         """
         if node.is_leaf():
-            return
-        for n in node.children:
-            TreePermutation._tag_nodes_(n)
-            
+            node.permutation_index = next(elements)
+            return shapes.setdefault((), len(shapes))
+
+        key = tuple(TreePermutation._tag_nodes_(n, elements, shapes) \
+                    for n in node.children)
+        shape = shapes.setdefault(key, len(shapes))
         node.permutation_index = min([ n.permutation_index for n in node.children ])
-        subtrees = []
-        for n in node.children:
-            if not any([ n.is_equal(t) for t in subtrees ]):
-                subtrees.append(n)
-        node.grouped_children = [ [ i for (i,c) in zip(range(len(node.children)), node.children) if c.is_equal(t) ] for t in subtrees ]
+        groups = {}
+        for i, s in enumerate(key):
+            groups.setdefault(s, []).append(i)
+        node.grouped_children = list(groups.values())
+        return shape
 
     def shuffle(self):        
         """
         Return a new random permutation based on this permutation.
         """
         shuffle(self.elements)
+        self._id_cache = None
         self._tag_()
         return self
 
-    def _update_elements_(self):
-        self.elements = [ n.permutation_index for n in self.tree if n.is_leaf() ]
-        
+    def inverse(self):
+        """
+        Get the inverse permutation of this permutation, mapped on a copy
+        of its tree.
+        """
+        ret = super().inverse()
+        # Leaves of the copy still hold this permutation elements.
+        ret._tag_()
+        return ret
+
     def canonical(self):
         """
         Sort permutation by shifting tree nodes based on the smallest leaf.
         Modifies this object in place.
         """        
-        ## Sort every node based on their permutation index.
-        nodes = [ n for n in self.tree if hasattr(n, 'grouped_children') ]
-        for n in nodes:
-            for g in n.grouped_children:
-                srted = sorted([(n.children[i].permutation_index,i) for i in g])
-                n.swap([ s[1] for s in srted ])
-        self._update_elements_()
+        if self._canonical:
+            return self
+        leaves = []
+        TreePermutation._canonical_nodes_(self.tree, leaves)
+        self._leaves = leaves
+        self.elements = array(_typecode,
+                              [ n.permutation_index for n in leaves ])
+        self._id_cache = None
+        self._canonical = True
         return self
 
+    @staticmethod
+    def _canonical_nodes_(node, leaves):
+        """
+        Sort groups of children of node and its subtree based on their
+        permutation index, and append leaves to @leaves in the new order.
+        """
+        if node.is_leaf():
+            leaves.append(node)
+            return
+        children = node.children
+        for g in node.grouped_children:
+            if len(g) > 1:
+                node.swap(sorted(g, key=lambda i: children[i].permutation_index))
+        for c in children:
+            TreePermutation._canonical_nodes_(c, leaves)
+
     def is_canonical(self) -> bool:
         """
         Return True if the permutation is already in a canonical form.
+        The result is cached until the permutation is modified.
+        """
+        if self._canonical is not None:
+            return self._canonical
+        self._canonical = self._is_canonical_()
+        return self._canonical
+
+    def _is_canonical_(self) -> bool:
+        """
+        Check that children of each group are sorted by permutation index.
         """
         for n in self.tree:
             if not hasattr(n, 'grouped_children'):
                 continue
             # Check that each individual group is ordered
             for group in n.grouped_children:
-                group = [ n.children[i] for i in group ]
-                index = [ c.permutation_index for c in n.children if c in group ]
+                if len(group) < 2:
+                    continue
+                index = [ n.children[i].permutation_index for i in sorted(group) ]
                 for i, j in zip(index[1:], index):
                     if i < j:
                         return False
@@ -249,7 +573,7 @@ class TreePermutation(Permutation):
         +   +    +   +
         0   1    2   3
         """
-        leaves = [ n for n in self.tree if n.is_leaf() ]
+        leaves = self._leaves_()
         item_size = max([ len(str(l.permutation_index)) for l in leaves ])
         if display_tree:
             lengths = {}
@@ -263,13 +587,14 @@ class TreePermutation(Permutation):
                 if len(coords) == 0:
                     lengths[coords] = off
 
-            depth = self.tree.max_depth()
+            # Nodes of each depth, from left to right.
+            top = self.tree.get_depth()
+            levels = [ [] ] * top + self.tree.levels()
+            depth = len(levels) - 1
             for i in range(depth+1):
                 i_line = ''
                 s_line = ''
-                for n in self.tree:
-                    if n.get_depth() != i:
-                        continue
+                for n in levels[i]:
                     coords = TreePermutation.Coords(n.coords())
                     offset = lengths[coords]
                     if len(coords) > 0 and coords[-1] == 0:
@@ -292,20 +617,242 @@ class TreePermutation(Permutation):
         together.
         Modifies this object in place.
         """
-        for node in TreeIterator(self.tree, lambda n: not n.is_leaf()):
-            for g in node.grouped_children:
+        leaves = []
+        TreePermutation._shuffle_nodes_(self.tree, leaves)
+        self._leaves = leaves
+        self.elements = array(_typecode,
+                              [ n.permutation_index for n in leaves ])
+        self._id_cache = None
+        self._canonical = None
+        return self
+
+    @staticmethod
+    def _shuffle_nodes_(node, leaves):
+        """
+        Shuffle groups of children of node and its subtree, and append
+        leaves to @leaves in the new order.
+        """
+        if node.is_leaf():
+            leaves.append(node)
+            return
+        for g in node.grouped_children:
+            if len(g) > 1:
                 shuffle(g)
                 node.swap(g)
-        self._update_elements_()
+        for c in node.children:
+            TreePermutation._shuffle_nodes_(c, leaves)
+
+class PermutationIterator:
+    """
+    Iterator on permutations in lexicographic order.
+    """
+
+    def __init__(self, permutation):
+        """
+        Create an iterator of permutations starting from @permutation
+        and stopping after the last permutation in lexicographic order.
+        @permutation can also be a number of elements, then iteration
+        starts from the identity and walks all the permutations.
+        """
+        if isinstance(permutation, int):
+            permutation = Permutation(permutation)
+        self._elems = permutation.elements.tolist()
+        self._done = False
+
+    def __iter__(self):
         return self
 
-__all__ = [ 'Permutation', 'TreePermutation' ]
+    def __next__(self):
+        if self._done:
+            raise StopIteration
+        ret = Permutation._from_list(self._elems)
+        # Step to the next permutation in place:
+        # Find the longest non-increasing suffix e[i+1:], swap e[i] with the
+        # smallest greater element of the suffix and reverse the suffix.
+        e = self._elems
+        i = len(e) - 2
+        while i >= 0 and e[i] >= e[i + 1]:
+            i -= 1
+        if i < 0:
+            self._done = True
+            return ret
+        j = len(e) - 1
+        while e[j] <= e[i]:
+            j -= 1
+        e[i], e[j] = e[j], e[i]
+        e[i + 1:] = e[:i:-1]
+        return ret
+
+class CanonicalPermutationIterator:
+    """
+    Iterator on the canonical permutations of a TreePermutation tree.
+    Each subgroup of permutations equivalent by shuffling tree nodes
+    is represented once, by its canonical permutation.
+    Canonical permutations are enumerated directly: leaves are assigned
+    values such that children of a group of swappable children are sorted
+    by their smallest value.
+    """
+
+    def __init__(self, permutation):
+        """
+        Create an iterator of canonical permutations mapped on the tree of
+        TreePermutation @permutation.
+        @permutation is not modified: the iterator works on a copy of its
+        tree and each permutation yielded has its own copy.
+        """
+        self.tree = deepcopy(permutation.tree)
+        shape, self._n = CanonicalPermutationIterator._shape_(self.tree)
+        self._elements = CanonicalPermutationIterator._assign_(
+            shape, list(range(self._n)))
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        # Permutations tag their tree: they cannot share it.
+        # Copy the tree structure only, tagged with the new elements.
+        elements = next(self._elements)
+        ret = TreePermutation._from_list(elements)
+        ret._leaves = []
+        ret.tree = CanonicalPermutationIterator._copy_(self.tree, None,
+                                                       iter(elements),
+                                                       ret._leaves)
+        ret._canonical = True
+        return ret
+
+    def ids(self):
+        """
+        Iterate the ids of the next canonical permutations, without building
+        TreePermutation objects.
+        """
+        for elements in self._elements:
+            yield _lehmer_encode(elements)
+
+    def imap(self, func, n_jobs=None, chunksize=1024):
+        """
+        Apply @func to the next canonical permutations in @n_jobs worker
+        processes (default: number of cpus) and iterate the results,
+        in completion order.
+        Workers receive permutation ids by chunks of @chunksize and
+        rebuild permutations on their own copy of the tree.
+        @func must be picklable, e.g. a module level function.
+        """
+        with Pool(n_jobs, initializer=_imap_init_,
+                  initargs=(self.tree, self._n, func)) as pool:
+            yield from pool.imap_unordered(_imap_call_, self.ids(), chunksize)
+
+    @staticmethod
+    def _copy_(node, parent, elements, leaves):
+        """
+        Copy @node and its subtree under @parent, keeping groups of
+        swappable children. Leaves are tagged with the next items of
+        @elements and appended to @leaves. Other node attributes are shared.
+        """
+        ret = object.__new__(type(node))
+        ret.__dict__.update(node.__dict__)
+        ret.parent = parent
+        if node.is_leaf():
+            ret.children = []
+            ret.permutation_index = next(elements)
+            leaves.append(ret)
+            return ret
+        ret.children = [ CanonicalPermutationIterator._copy_(c, ret, elements,
+                                                             leaves) \
+                         for c in node.children ]
+        ret.permutation_index = min([ c.permutation_index \
+                                      for c in ret.children ])
+        ret.grouped_children = [ g.copy() for g in node.grouped_children ]
+        return ret
+
+    @staticmethod
+    def _shape_(node):
+        """
+        Snapshot of node children layout: (children shapes, group index of
+        each child, number of leaves of each child) or None for leaves.
+        Return the shape and the number of leaves below node.
+        """
+        if node.is_leaf():
+            return None, 1
+        shapes, sizes = zip(*[ CanonicalPermutationIterator._shape_(c) \
+                               for c in node.children ])
+        groups = [ 0 ] * len(node.children)
+        for g, group in enumerate(node.grouped_children):
+            for i in group:
+                groups[i] = g
+        # pending[i][g]: number of leaves of children after i in group g.
+        pending = [ [ 0 ] * len(node.grouped_children) ]
+        for g, size in zip(reversed(groups[1:]), reversed(sizes[1:])):
+            pending.append(pending[-1].copy())
+            pending[-1][g] += size
+        pending.reverse()
+        return (shapes, groups, sizes, pending), sum(sizes)
+
+    @staticmethod
+    def _assign_(shape, values):
+        """
+        Yield canonical lists of sorted @values assigned to the leaves of a
+        node of shape @shape, from left to right.
+        """
+        if shape is None:
+            yield [ values[0] ]
+            return
+        yield from CanonicalPermutationIterator._distribute_(shape, 0, values,
+                                                             {})
+
+    @staticmethod
+    def _distribute_(shape, i, values, floors):
+        """
+        Yield canonical assignments of sorted @values to children i and
+        onward of a node of shape @shape.
+        @floors maps a group to the smallest value of its last assigned child.
+        Children of a group must take values greater than the group floor.
+        """
+        shapes, groups, sizes, pending = shape
+        if i == len(shapes):
+            yield []
+            return
+        g = groups[i]
+        floor = floors.get(g, -1)
+        for subset in combinations([ v for v in values if v > floor ], sizes[i]):
+            chosen = set(subset)
+            rest = [ v for v in values if v not in chosen ]
+            next_floors = floors.copy()
+            next_floors[g] = subset[0]
+            # Prune assignments leaving too few large enough values for the
+            # next children of each group.
+            if any(len(rest) - bisect_right(rest, next_floors.get(h, -1)) < n \
+                   for h, n in enumerate(pending[i]) if n > 0):
+                continue
+            for head in CanonicalPermutationIterator._assign_(shapes[i],
+                                                              list(subset)):
+                for tail in CanonicalPermutationIterator._distribute_(
+                        shape, i + 1, rest, next_floors):
+                    yield head + tail
+
+"""
+Tree, number of leaves and function of CanonicalPermutationIterator.imap()
+in worker processes.
+"""
+_imap_args = None
+
+def _imap_init_(*args):
+    global _imap_args
+    _imap_args = args
+
+def _imap_call_(id):
+    tree, n, func = _imap_args
+    return func(TreePermutation(tree, n, id))
+
+__all__ = [ 'Permutation', 'TreePermutation', 'PermutationIterator',
+            'CanonicalPermutationIterator' ]
 
 ################################################################################
 # Testing                                                                      #
 ################################################################################
 
 import unittest
+import pickle
+from unittest.mock import patch
 
 class TestPermutations(unittest.TestCase):
     @classmethod
@@ -313,8 +860,11 @@ class TestPermutations(unittest.TestCase):
         trials = 20
         size_min = 4
         size_max = 256
-        sizes = [ randint(size_min, size_max) for i in range(trials) ]
-        cls.ids = [ randint(0, factorial(s)) for s in sizes ]
+        rng = Random(0)
+        sizes = [ rng.randint(size_min, size_max) for i in range(trials) ]
+        # 8 extra random bits make the modulo bias negligible.
+        cls.ids = [ rng.getrandbits(f.bit_length() + 8) % f \
+                    for f in map(factorial, sizes) ]
         cls.permutations = [ Permutation(size, id) \
                              for size, id in zip(sizes, cls.ids) ]
     
@@ -322,7 +872,10 @@ class TestPermutations(unittest.TestCase):
         for permutation in self.permutations:
             copy = permutation.copy()
             self.assertEqual(copy, permutation)
+            self.assertEqual(len({ copy, permutation }), 1)
             self.assertNotEqual(copy.shuffle(), permutation)
+            self.assertEqual(pickle.loads(pickle.dumps(permutation)),
+                             permutation)
         
     def test_id(self):
         for id, permutation in zip(self.ids, self.permutations):
@@ -334,12 +887,54 @@ class TestPermutations(unittest.TestCase):
             permutation = Permutation(len(permutation), shuffled.id())
             self.assertEqual(shuffled, permutation)
 
+    def test_factoradic_blocks(self):
+        for id, permutation in zip(self.ids, self.permutations):
+            n = len(permutation)
+            digits, _ = _factoradic(n, id)
+            digits += [0] * (n - len(digits))
+            with patch.object(sys.modules[__name__], '_block_threshold', 0):
+                block_digits, _ = _factoradic(n, id)
+                block_digits += [0] * (n - len(block_digits))
+                self.assertEqual(block_digits, digits)
+                self.assertEqual(_horner(digits), id)
+                self.assertEqual(_factoradic(n, id + 3 * factorial(n))[1], 3)
+            self.assertEqual(_horner(digits), id)
+
+    def test_unrank_function(self):
+        for n in [ 0, 1, 2, 5, 13 ]:
+            f = factorial(n)
+            ids = [ 0, f - 1, f + 1, 3 * f ] + \
+                [ randint(0, f) for i in range(10) ]
+            unrolled = [ _lehmer_decode(n, id) for id in ids ]
+            with patch.object(sys.modules[__name__], '_unrank_threshold', 0):
+                generic = [ _lehmer_decode(n, id) for id in ids ]
+            self.assertEqual(unrolled, generic)
+
+    def test_lehmer_fenwick(self):
+        for id, permutation in zip(self.ids, self.permutations):
+            n = len(permutation)
+            with patch.object(sys.modules[__name__], '_fenwick_threshold', 0):
+                fenwick_code = (_lehmer_encode(permutation.elements),
+                                _lehmer_decode(n, id))
+            self.assertEqual(fenwick_code, (_lehmer_encode(permutation.elements),
+                                            _lehmer_decode(n, id)))
+
     def test_add(self):
         for permutation in self.permutations:
             other = Permutation(len(permutation), randint(0, sys.maxsize))
             self.assertEqual((other + permutation).id(),
                              (permutation.id() + other.id()) % permutation.max_id)
 
+    def test_iterator(self):
+        permutations = [ p.elements.tolist() for p in PermutationIterator(5) ]
+        self.assertEqual(len(permutations), factorial(5))
+        self.assertEqual(permutations, sorted(permutations))
+        self.assertEqual(len(set(map(tuple, permutations))), factorial(5))
+        start = Permutation([2, 4, 3, 1, 0])
+        self.assertEqual(next(PermutationIterator(start)), start)
+        self.assertEqual(len(list(PermutationIterator(start))),
+                         factorial(5) - permutations.index(start.elements.tolist()))
+
 class TestTreePermutation(unittest.TestCase):
     @classmethod
     def setUpClass(cls):
@@ -352,8 +947,11 @@ class TestTreePermutation(unittest.TestCase):
         for i in range(trials):
             arities.append([ randint(arity_min, arity_max) \
                              for i in range(randint(depth_min, depth_max)) ])
-        trees = [ Tleaf(a) for a in arities ]
-        cls.permutations = [ TreePermutation(t).shuffle() for t in trees ]
+        # Shuffle before mapping on the tree: trees are tagged only once.
+        cls.permutations = []
+        for a in arities:
+            elements = Permutation(reduce(lambda x, y: x * y, a)).shuffle()
+            cls.permutations.append(TreePermutation(Tleaf(a), elements))
         
     def test_canonical(self):
         for permutation in self.permutations:
@@ -362,5 +960,52 @@ class TestTreePermutation(unittest.TestCase):
             equivalent = permutation.copy().shuffle_nodes()
             self.assertEqual(equivalent.canonical(), canonical)
 
+    def test_inverse(self):
+        for permutation in self.permutations:
+            inverse = permutation.copy().canonical().inverse()
+            self.assertEqual(inverse.is_canonical(), inverse._is_canonical_())
+            self.assertTrue(inverse.canonical()._is_canonical_())
+        inverse = TreePermutation(Tleaf([2, 2]), 4, 5).canonical().inverse()
+        self.assertEqual(list(inverse.canonical().elements), [0, 2, 1, 3])
+
+    def test_grouped_children(self):
+        # Only subtrees of the same shape may be swapped.
+        for i in range(20):
+            permutation = TreePermutation(Trandom()).shuffle()
+            shape = [ n.arity() for n in permutation.tree ]
+            permutation.shuffle_nodes()
+            self.assertEqual([ n.arity() for n in permutation.tree ], shape)
+
+    def test_canonical_iterator(self):
+        for arities in [ [2, 3], [3, 2], [2, 2, 2] ]:
+            permutation = TreePermutation(Tleaf(arities))
+            canonicals = set()
+            for p in PermutationIterator(len(permutation)):
+                p = TreePermutation(Tleaf(arities), p).canonical()
+                canonicals.add(tuple(p.elements))
+            iterated = [ p for p in CanonicalPermutationIterator(permutation) ]
+            # Yielded permutations are canonical and own their tree.
+            for p in iterated:
+                self.assertTrue(p._is_canonical_())
+            iterated = [ tuple(p.elements) for p in iterated ]
+            for p, elements in zip(CanonicalPermutationIterator(permutation),
+                                   iterated):
+                self.assertEqual(tuple(p.shuffle_nodes().canonical()),
+                                 elements)
+            self.assertEqual(len(iterated), len(canonicals))
+            self.assertEqual(set(iterated), canonicals)
+        # The input permutation is left intact.
+        q = TreePermutation(Tleaf([2, 2]), [3, 2, 1, 0])
+        next(CanonicalPermutationIterator(q))
+        self.assertFalse(q.is_canonical())
+        self.assertEqual(list(q.canonical().elements), [0, 1, 2, 3])
+
+    def test_canonical_iterator_imap(self):
+        permutation = TreePermutation(Tleaf([2, 2, 2]))
+        ids = list(CanonicalPermutationIterator(permutation).ids())
+        iterated = CanonicalPermutationIterator(permutation).imap(
+            TreePermutation.id, n_jobs=2, chunksize=4)
+        self.assertEqual(sorted(iterated), sorted(ids))
+
 if __name__ == '__main__':
     unittest.main()
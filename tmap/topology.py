@@ -7,23 +7,48 @@
 # SPDX-License-Identifier: BSD-3-Clause
 ##############################################################################
 
-from tmap.tree import Tree, TreeIterator
+from tmap.tree import Tree
 from tmap.permutation import TreePermutation
 from xml.etree import ElementTree
 import subprocess
 import re
 import os
+from io import BytesIO
+import zlib
+from sys import intern
 from copy import deepcopy
-from tmap.utils import which
+from shutil import which
 from socket import gethostname
-from functools import reduce
+from itertools import chain
+
+"Pattern of hwloc version, major.minor.revision."
+_version_pattern = re.compile(r'(\d+)\.(\d+)\.(\d+)')
 
 hwloc_version=None
-s, out = subprocess.getstatusoutput('hwloc-info --version')
-if s == 0:
-    hwloc_version = re.match('.*(?P<i>\d[.]\d[.]\d).*',out)
+# Don't spawn a process when hwloc is not installed.
+if which('hwloc-info') is not None:
+    proc = subprocess.run(['hwloc-info', '--version'], capture_output=True)
+    if proc.returncode == 0:
+        hwloc_version = _version_pattern.search(proc.stdout.decode())
 if hwloc_version is not None:
-    hwloc_version = [ int(i) for i in hwloc_version.group(1).split('.') ]
+    hwloc_version = [ int(i) for i in hwloc_version.groups() ]
+
+def _is_int_(value: str):
+    """
+    Whether xml attribute @value is an optionally signed ascii integer
+    converted to int.
+    """
+    digits = value[1:] if value[:1] in ('-', '+') else value
+    return digits.isdecimal() and digits.isascii()
+
+"""
+Node attributes not deep copied by Topology.dup(): links, PUs remapped on
+copied nodes, and xml attributes never modified.
+"""
+_dup_shared = frozenset(('parent', 'children', 'PUs', 'attrib'))
+
+"Cache of lstopo xml outputs, by lstopo command line."
+_lstopo_xml = {}
 
 class Topology(Tree):
     """
@@ -31,31 +56,97 @@ class Topology(Tree):
     """
 
     @staticmethod
-    def make_node(xml_node, node=None):
+    def make_node(xml_node, node=None, hostname=None):
         if node is None:
-            node = Tree()
+            # Topology.__init__ runs lstopo, build a bare node instead.
+            node = Topology.__new__(Topology)
+            Tree.__init__(node)
         node.tag = xml_node.tag
-        node.attrib = xml_node.attrib
-        node.hostname = gethostname()
-        for k,v in xml_node.attrib.items():
-            # Don't override attributes
-            if k in node.__dict__.keys():
-                continue
-            try:
-                node.__dict__[k] = int(v)
-            except ValueError:
-                node.__dict__[k] = v
+        # Interned values are shared among nodes (types, identical cpusets)
+        # and compare to literals by identity.
+        node.attrib = { k: intern(v) for k, v in xml_node.attrib.items() }
+        node.hostname = gethostname() if hostname is None else hostname
+        # Don't override attributes. Convert integer attributes.
+        attrs = node.__dict__
+        attrs.update({ k: int(v) if _is_int_(v) else v \
+                       for k, v in node.attrib.items() if k not in attrs })
         if node.__class__ is Tree:
             node.__class__ = Topology
         return node
 
-    def connect_children_xml(self, xml_node):
+    def parse_xml(self, xml: bytes):
+        """
+        Make this node the root of the topology in lstopo @xml output.
+        Nodes are built while parsing, and xml elements are dropped as soon
+        as they are processed.
+        """
         self.children = []
-        for child in list(xml_node):
-            node = Topology.make_node(child)
-            node.parent = self
-            self.children.append(node)
-            node.connect_children_xml(child)
+        parents = []
+        hostname = gethostname()
+        make_node = Topology.make_node
+        for event, elem in ElementTree.iterparse(BytesIO(xml),
+                                                 events=('start', 'end')):
+            if event == 'end':
+                parents.pop()
+                elem.clear()
+            elif len(parents) == 0:
+                parents.append(make_node(elem, self, hostname))
+            else:
+                node = make_node(elem, None, hostname)
+                node.parent = parents[-1]
+                parents[-1].children.append(node)
+                parents.append(node)
+
+    @staticmethod
+    def _lstopo_cmd_(input_topology=None, structure=True, no_io=True):
+        """
+        lstopo xml export command line for the given Topology constructor
+        options.
+        """
+        cmd = ('lstopo', '--of', 'xml')
+        if input_topology is not None:
+            if os.path.isfile(os.path.expanduser(input_topology)):
+                input_topology = os.path.expanduser(input_topology)
+            cmd += ('--input', input_topology)
+            if structure:
+                cmd += ('--filter', 'all:structure')
+            if no_io:
+                cmd += ('--no-io',)
+        return cmd
+
+    @staticmethod
+    def export_xml(path, input_topology=None, structure=True, no_io=True):
+        """
+        Export lstopo xml for the given Topology constructor options to
+        file @path. The file is replaced atomically, such that concurrent
+        processes read either the old or the new file.
+        """
+        tmp = '{}.{}.tmp'.format(path, os.getpid())
+        cmd = Topology._lstopo_cmd_(input_topology, structure, no_io)
+        try:
+            subprocess.run(cmd + (tmp,), capture_output=True, check=True)
+            os.replace(tmp, path)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+    @staticmethod
+    def get_lstopo_xml(input_topology=None, structure=True, no_io=True):
+        """
+        Get lstopo xml output (bytes) for the given Topology constructor
+        options.
+        Successful outputs are cached for the lifetime of the process,
+        such that lstopo runs once per set of options.
+        """
+        cmd = Topology._lstopo_cmd_(input_topology, structure, no_io)
+        output = _lstopo_xml.get(cmd)
+        if output is None:
+            proc = subprocess.run(cmd, capture_output=True)
+            if proc.returncode != 0:
+                return proc.stdout + proc.stderr
+            output = proc.stdout
+            _lstopo_xml[cmd] = output
+        return output
 
     def __init__(self, input_topology=None,
                  structure=True, no_io=True, cpuset_only=True):
@@ -67,47 +158,52 @@ class Topology(Tree):
         """
 
         if input_topology is not None and input_topology[-4:] == '.xml':
-            with open(input_topology) as f:
+            with open(input_topology, 'rb') as f:
                 output = f.read()
         else:
-            cmd = 'lstopo --of xml'
-            if input_topology is not None:
-                if os.path.isfile(os.path.expanduser(input_topology)):
-                    cmd += ' --input {}'.format(input_topology)
-                else:
-                    cmd += ' --input "{}"'.format(input_topology)
-                if structure:
-                    cmd += ' --filter all:structure'
-                if no_io:
-                    cmd += ' --no-io'
-                    
-            output = subprocess.getoutput(cmd)
+            output = Topology.get_lstopo_xml(input_topology, structure, no_io)
+        self._build_(output, cpuset_only)
+
+    @classmethod
+    def from_xml(cls, xml: bytes, cpuset_only=True):
+        """
+        Build a topology from lstopo @xml output (bytes), e.g. an xml
+        exported earlier, without running lstopo.
+        """
+        ret = cls.__new__(cls)
+        ret._build_(xml, cpuset_only)
+        return ret
+
+    def _build_(self, output: bytes, cpuset_only: bool):
+        """
+        Build topology nodes below this root from lstopo xml @output.
+        """
+        # Initialize root and connect children while parsing.
+        Tree.__init__(self, logical_index=0)
         try:
-            root = ElementTree.fromstring(output)
+            self.parse_xml(output)
         except Exception as e:
-            print("Invalid lstopo xml topology:\n{}".format(output))
+            print("Invalid lstopo xml topology:\n{}".format(
+                output.decode(errors='replace')))
             raise e
-
-        # Initialize root
-        super().__init__(logical_index=0)
-        Topology.make_node(root, self)
-
-        # Connect childrens recursively
-        self.connect_children_xml(root)
             
         if cpuset_only:
-            self.prune(lambda n: not n.has_cpuset())
-
-        # Set logical indexes:
-        types = set([ n.type for n in self if hasattr(n, 'type') ])
-        for t in types:
-            nodes = [ n for n in self if hasattr(n, 'type') and n.type == t ]
-            for n, i in zip(nodes, range(len(nodes))):
-                n.logical_index = i        
+            self.prune_cpusetless()
 
-        # Set list of child PUs:
+        # Set logical indexes and list of child PUs in one pass.
+        # Iteration is post-order: children PUs are set before their parent's.
+        counts = {}
         for n in self:
-            n.PUs = [ i for i in n if hasattr(i, 'type') and i.type == 'PU' ]
+            PUs = []
+            for c in n.children:
+                PUs.extend(c.PUs)
+            t = getattr(n, 'type', None)
+            if t is not None:
+                n.logical_index = counts.get(t, 0)
+                counts[t] = n.logical_index + 1
+                if t == 'PU':
+                    PUs.append(n)
+            n.PUs = PUs
 
     def __repr__(self):
         if hasattr(self, 'type'):
@@ -117,12 +213,85 @@ class Topology(Tree):
 
     # Remove nodes with no cpuset.
     def has_cpuset(self):
-        if hasattr(self, 'type') and self.type == 'PU':
+        if getattr(self, 'type', None) == 'PU':
             return True
             
         ## If no child has cpuset, then this has no cpuset.
         return next((True for c in self.children if c.has_cpuset()), False)
 
+    def prune_cpusetless(self):
+        """
+        Prune nodes with no cpuset, i.e with no PU in their subtree.
+        """
+        # Nodes with a cpuset are computed bottom-up in one post-order pass.
+        with_cpuset = set()
+        for n in self:
+            if getattr(n, 'type', None) == 'PU' or \
+               any(id(c) in with_cpuset for c in n.children):
+                with_cpuset.add(id(n))
+        return self.prune(lambda n: id(n) not in with_cpuset)
+
+    def update_PUs(self):
+        """
+        Update list of child PUs of this node and its ancestors, after
+        removing nodes.
+        """
+        # Iteration is post-order: children PUs are set before their parent's.
+        for n in self:
+            if len(n.children) > 0:
+                n.PUs = list(chain.from_iterable(c.PUs for c in n.children))
+        p = self.parent
+        while p is not None:
+            p.PUs = list(chain.from_iterable(c.PUs for c in p.children))
+            p = p.parent
+        return self
+
+    def restrict(self, indexes, type='PU'):
+        """
+        Restrict topology to objects of type @type with a logical index
+        in @indexes, their ancestors and descendants.
+        Logical indexes are not renumbered.
+        """
+        if not Topology._restrict_(self, type, frozenset(indexes)) and \
+           self.parent is not None:
+            del self.parent.children[self.index()]
+        p = self.parent
+        while p is not None:
+            p.PUs = list(chain.from_iterable(c.PUs for c in p.children))
+            p = p.parent
+        return self
+
+    @staticmethod
+    def _restrict_(node, type, indexes):
+        """
+        Post-order pass of restrict(): unlink children left without PUs
+        and update PUs lists. Return True if node has PUs left.
+        """
+        if getattr(node, 'type', None) == type and \
+           node.logical_index not in indexes:
+            return False
+        if len(node.children) == 0:
+            return getattr(node, 'type', None) == 'PU'
+        node.children = [ c for c in node.children \
+                          if Topology._restrict_(c, type, indexes) ]
+        node.PUs = list(chain.from_iterable(c.PUs for c in node.children))
+        return len(node.children) > 0
+
+    def iter_by_type(self, type: str):
+        """
+        Iterate nodes of type @type in this topology, in TreeIterator order.
+        """
+        path = [ (self, iter(self.children)) ]
+        while len(path) > 0:
+            node, children = path[-1]
+            child = next(children, None)
+            if child is not None:
+                path.append((child, iter(child.children)))
+            else:
+                path.pop()
+                if getattr(node, 'type', None) == type:
+                    yield node
+
     def set_hostname(self, hostname):
         """
         Set attribute hostname of topology nodes to the `hostname` value.
@@ -132,44 +301,58 @@ class Topology(Tree):
             n.hostname = hostname
 
     def get_nbobjs_by_type(self, type: str):
-        return len(self.select(lambda n: hasattr(self, 'type') and n.type == type))
+        return sum(1 for n in self.iter_by_type(type))
+
+    def children_map(self, parent_type: str, child_type: str) -> dict:
+        """
+        Map logical index of each object of type @parent_type to the list of
+        logical indexes of objects of type @child_type below it, in one walk.
+        """
+        ret = {}
+        nodes = [ (self, None) ]
+        while len(nodes) > 0:
+            n, owner = nodes.pop()
+            t = getattr(n, 'type', None)
+            if t == child_type and owner is not None:
+                owner.append(n.logical_index)
+            if t == parent_type:
+                owner = ret.setdefault(n.logical_index, [])
+            nodes.extend((c, owner) for c in reversed(n.children))
+        return ret
 
     def get_obj_by_type(self, type: str, index: int, physical=False):
-        if physical:
-            def match(n): return hasattr(self, 'type') and n.type == type and n.os_index == index
-        else:
-            def match(n): return hasattr(self, 'type') and n.type == type and n.logical_index == index
-        return next((TreeIterator(self, match)), None)
+        attr = 'os_index' if physical else 'logical_index'
+        return next((n for n in self.iter_by_type(type) \
+                     if getattr(n, attr, None) == index), None)
     
     def singlify(self, level = "Machine"):
         """
         Restrict descendants of nodes with this type to a string of descendants 
         down to a single PU.
         """
-        if len(self.children) == 0:
+        nodes = [ self ]
+        singlified = False
+        while len(nodes) > 0:
+            n = nodes.pop()
+            if getattr(n, 'type', None) == level:
+                while len(n.children) > 0:
+                    child = next(c for c in n.children if c.has_cpuset())
+                    n.children = [ child ]
+                    n = child
+                singlified = True
+            else:
+                nodes.extend(n.children)
+        if not singlified:
             return self
-        if hasattr(self, 'type') and self.type == level:
-            child = next(c for c in self.children if c.has_cpuset())
-            child.singlify(level = child.type)
-            self.children = [ child ]
-            self.PUs = child.PUs
-            p = self.parent
-            while p is not None:
-                p.PUs = reduce(lambda x, y: x+y, [c.PUs for c in p.children], [])
-                p = p.parent
-        else:
-            for n in self.children:
-                n.singlify(level)
-        return self
+        return self.update_PUs()
 
     def flatten(self):
         """
         Cut nodes between root and leaves with an arity of 1.
         """
-        e = next((n for n in self if n.arity()==1), None)
-        while e is not None:
-            e.remove()
-            e = next((n for n in self if n.arity()==1), None)
+        # Removing a node does not change other nodes arity.
+        for n in [ n for n in self if n.arity() == 1 ]:
+            n.remove()
         return self
 
     def split(self, n=2):
@@ -181,16 +364,16 @@ class Topology(Tree):
         num = len(self.children) // n
         children = [ self.children[i:i+num] for i in range(0, len(self.children), num) ]
         self.children = []
-        children = [ Tree(self, c) for c in children ]
+        for c in children:
+            # PUs of the new node are its children's, in order.
+            Tree(self, c).PUs = list(chain.from_iterable(i.PUs for i in c))
         return self
 
     def split_type(self, level_type, n=2):
         """
         Split all node of given type when possible.
         """
-        nodes = list(TreeIterator(self,
-                                  lambda node: hasattr(node, 'type') and \
-                                  node.type == level_type))
+        nodes = list(self.iter_by_type(level_type))
         for node in nodes:
             try:
                 node.split(n)
@@ -200,15 +383,171 @@ class Topology(Tree):
         return self
 
     def dup(self):
-        return deepcopy(self)
+        """
+        Copy of this topology, detached from its parent.
+        Nodes are copied with their attributes. XML attributes dictionaries
+        are shared since they are never modified. PUs lists refer to copied
+        nodes.
+        """
+        copies = {}
+        ret = Topology._dup_node_(self, None, copies)
+        for n in copies.values():
+            if 'PUs' in n.__dict__:
+                n.PUs = [ copies.get(id(pu), pu) for pu in n.PUs ]
+        return ret
 
-"Pre initialized current machine topology."
+    @staticmethod
+    def _dup_node_(node, parent, copies):
+        """
+        Copy @node subtree under @parent.
+        @copies maps original nodes id to their copy.
+        """
+        cls = node.__class__
+        ret = cls.__new__(cls)
+        attrs = node.__dict__.copy()
+        for k, v in attrs.items():
+            if k in _dup_shared or isinstance(v, (int, str, float, bool)):
+                continue
+            if k == 'grouped_children':
+                # Set by TreePermutation: a list of lists of int.
+                attrs[k] = [ g[:] for g in v ]
+            else:
+                attrs[k] = deepcopy(v)
+        attrs['parent'] = parent
+        attrs['children'] = [ Topology._dup_node_(c, ret, copies) \
+                              for c in node.children ]
+        ret.__dict__ = attrs
+        copies[id(node)] = ret
+        return ret
+
+def _topology_snapshot_path_():
+    """
+    Path of the current machine topology xml snapshot, if snapshots are
+    enabled with environment variable TMAP_TOPOLOGY_CACHE=1, else None.
+    Snapshots are valid for a boot, an hwloc version and a set of
+    allowed cpus.
+    """
+    if os.environ.get('TMAP_TOPOLOGY_CACHE', '0') in ('', '0'):
+        return None
+    try:
+        with open('/proc/sys/kernel/random/boot_id') as f:
+            boot_id = f.read().strip()
+    except OSError:
+        return None
+    cpus = sorted(os.sched_getaffinity(0)) \
+        if hasattr(os, 'sched_getaffinity') else []
+    cache = os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache'))
+    return os.path.join(cache, 'tmap', 'topology-{}-{}-{:08x}.xml'.format(
+        boot_id, '.'.join(str(i) for i in hwloc_version),
+        zlib.crc32(repr(cpus).encode())))
+
+def __getattr__(name):
+    """
+    Build the current machine topology on first access to module
+    attribute 'topology', from its xml snapshot if enabled.
+    """
+    global topology
+    if name != 'topology' or hwloc_version is None:
+        raise AttributeError("module {!r} has no attribute {!r}".format(
+            __name__, name))
+    path = _topology_snapshot_path_()
+    if path is None:
+        topology = Topology()
+    else:
+        if not os.path.isfile(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            Topology.export_xml(path)
+        topology = Topology(path)
+    return topology
+
+"Current machine topology, built on first access."
 if hwloc_version is not None:
-    topology = Topology()
     __all__ = ['hwloc_version', 'topology', 'Topology']
 else:
     __all__ = ['hwloc_version', 'Topology']
 
+################################################################################
+# Testing                                                                      #
+################################################################################
+
+import unittest
+
+class TestTopology(unittest.TestCase):
+    # Two packages of two cores of two PUs, with io objects without cpuset.
+    xml = b"""<?xml version="1.0" encoding="UTF-8"?>
+<topology version="2.0">
+<object type="Machine" os_index="0" cpuset="0xff">
+<info name="Backend" value="Linux"/>
+<object type="Package" os_index="0" cpuset="0x0f">
+<object type="L2Cache" depth="2"><object type="Core" os_index="0">
+<object type="PU" os_index="0"/><object type="PU" os_index="1"/>
+</object></object>
+<object type="L2Cache" depth="2"><object type="Core" os_index="1">
+<object type="PU" os_index="2"/><object type="PU" os_index="3"/>
+</object></object>
+<object type="Bridge" os_index="0"><object type="PCIDev" os_index="0"/></object>
+</object>
+<object type="Package" os_index="1" cpuset="0xf0">
+<object type="L2Cache" depth="2"><object type="Core" os_index="2">
+<object type="PU" os_index="7"/><object type="PU" os_index="6"/>
+</object></object>
+<object type="L2Cache" depth="2"><object type="Core" os_index="3">
+<object type="PU" os_index="5"/><object type="PU" os_index="4"/>
+</object></object>
+</object>
+</object>
+</topology>"""
+
+    def setUp(self):
+        self.topology = Topology.from_xml(self.xml)
+
+    def test_from_xml(self):
+        t = self.topology
+        self.assertEqual([ pu.logical_index for pu in t.PUs ], list(range(8)))
+        self.assertEqual(t.get_nbobjs_by_type('Core'), 4)
+        self.assertEqual(t.get_nbobjs_by_type('Bridge'), 0)
+        self.assertEqual(t.get_obj_by_type('PU', 7, physical=True).logical_index,
+                         4)
+
+    def test_flatten(self):
+        t = self.topology.flatten()
+        s = str(t)
+        self.assertNotIn('L2Cache', s)
+        self.assertIn('Core:3', s)
+        self.assertIn('PU:7', s)
+
+    def test_restrict(self):
+        t = self.topology.restrict([0, 5])
+        self.assertEqual([ pu.logical_index for pu in t.PUs ], [0, 5])
+        self.assertEqual([ n.logical_index for n in t.iter_by_type('Core') ],
+                         [0, 2])
+        self.assertEqual(t.get_nbobjs_by_type('Package'), 2)
+
+    def test_dup(self):
+        t = self.topology
+        d = t.dup()
+        self.assertEqual(str(d), str(t))
+        copies = set(id(n) for n in d)
+        for n, c in zip(t, d):
+            self.assertIsNot(n, c)
+            self.assertEqual([ repr(pu) for pu in c.PUs ],
+                             [ repr(pu) for pu in n.PUs ])
+            self.assertTrue(all(id(pu) in copies for pu in c.PUs))
+
+    def test_children_map(self):
+        self.assertEqual(self.topology.children_map('Package', 'PU'),
+                         { 0: [0, 1, 2, 3], 1: [4, 5, 6, 7] })
+        self.assertEqual(self.topology.children_map('Package', 'Core'),
+                         { 0: [0, 1], 1: [2, 3] })
+
+    def test_prune(self):
+        t = self.topology
+        t.prune(lambda n: getattr(n, 'type', None) == 'PU' and \
+                n.logical_index > 3)
+        self.assertEqual(t.get_nbobjs_by_type('PU'), 4)
+        self.assertIsNone(t.get_obj_by_type('PU', 5))
+        self.assertEqual(t.get_obj_by_type('PU', 2).logical_index, 2)
+
 if __name__ == '__main__':
     t = Topology()
     print(t)
@@ -8,7 +8,7 @@
 ##############################################################################
 
 from random import randint
-from tmap.utils import concat, which, isindex
+from itertools import chain
 
 class Tree:
     """
@@ -56,20 +56,45 @@ class Tree:
         """
         Output multiline nice tree representation where nodes are repr(node) 
         """
-        s = ""
-        depth = self.max_depth()
-        for n in self:
-            coords = n.coords()
+        lines = []
+        # Walk in TreeIterator order, keeping coordinates of the current
+        # node up to date instead of computing them for each node.
+        # indents[i] is the line prefix of nodes with i+1 coordinates.
+        coords = []
+        indents = []
+        def push(i):
+            d = len(coords)
+            indents.append('' if d == 0 else indents[-1] + \
+                           ('|' if coords[-1] != 0 else ' ') + (' ' * d * 3))
+            coords.append(i)
+        for i in self.coords():
+            push(i)
+        nodes = [ (self, enumerate(self.children)) ]
+        while len(nodes) > 0:
+            n, children = nodes[-1]
+            child = next(children, None)
+            if child is not None and child[1].parent is None:
+                # A node detached from its parent, e.g by remove(), ends
+                # the walk as in TreeIterator. Its subtree is printed
+                # with coordinates relative to it.
+                lines.append(Tree.__str__(child[1]))
+                break
+            if child is not None:
+                push(child[0])
+                nodes.append((child[1], enumerate(child[1].children)))
+                continue
+            nodes.pop()
             if len(coords) == 0:
                 continue
-            for i in range(len(coords) - 1):
-                s += ('|' if coords[i] != 0 else ' ') + (' ' * (i + 1) * 3)
-            s += '+' + ('-' * len(coords) * 3) + '{}\n'.format(repr(n))
-            if n != n.parent.children[-1]:
-                for i in range(len(coords) - 1):
-                    s += ('|' if coords[i] != 0 else ' ') + (' ' * (i + 1) * 3)
-                s += '|' + ' ' * (len(coords) * 3 + 3) + '\n'
-        return s
+            indent = indents.pop()
+            # Default repr is the coordinates, already known here.
+            label = str(coords) if type(n).__repr__ is Tree.__repr__ \
+                else repr(n)
+            lines.append(indent + '+' + ('-' * len(coords) * 3) + label + '\n')
+            if coords[-1] != len(n.parent.children) - 1:
+                lines.append(indent + '|' + ' ' * (len(coords) * 3 + 3) + '\n')
+            coords.pop()
+        return ''.join(lines)
 
     def __iter__(self):
         """
@@ -77,8 +102,33 @@ class Tree:
         """
         return TreeIterator(self)
 
+    def iter_leaves(self):
+        """
+        Iterate leaves of this tree, in TreeIterator order.
+        """
+        nodes = [ self ]
+        pop = nodes.pop
+        extend = nodes.extend
+        while len(nodes) > 0:
+            n = pop()
+            if len(n.children) > 0:
+                extend(reversed(n.children))
+            else:
+                yield n
+
     def is_equal(self, other):
-        return next((False for a,b in zip(iter(self), iter(other)) if a.arity() != b.arity()), True)
+        """
+        Return True if this tree and @other have the same shape, i.e same
+        arity at same coordinates.
+        """
+        # Walk both trees together and stop on the first arity mismatch.
+        nodes = [ (self, other) ]
+        while len(nodes) > 0:
+            a, b = nodes.pop()
+            if len(a.children) != len(b.children):
+                return False
+            nodes.extend(zip(a.children, b.children))
+        return True
 
     def connect_children(self, *args):
         """
@@ -113,7 +163,7 @@ class Tree:
         """
         Return True if this node is the Tree root node
         """
-        return self.parent == None
+        return self.parent is None
 
     def is_leaf(self) -> bool:
         """
@@ -123,11 +173,14 @@ class Tree:
 
     def get_depth(self) -> int:
         """
-        Compute recursively this node leaf
+        Compute this node depth, i.e its distance to the root.
         """
-        if self.parent is None:
-            return 0
-        return 1 + self.parent.get_depth()
+        depth = 0
+        n = self.parent
+        while n is not None:
+            depth += 1
+            n = n.parent
+        return depth
 
     def arity(self):
         """
@@ -137,42 +190,50 @@ class Tree:
 
     def max_depth(self) -> int:
         """
-        Compute recursively maximum distance to a leaf from this node
+        Compute the depth of the deepest leaf below this node.
         """
-        return max(
-            [l.get_depth() for l in TreeIterator(self, lambda n: n.is_leaf())])
+        # Walk down one level at a time until no node has children.
+        depth = self.get_depth()
+        nodes = self.children
+        while len(nodes) > 0:
+            depth += 1
+            nodes = [ c for n in nodes for c in n.children ]
+        return depth
 
     def __getitem__(self, coords: list):
         """
         Retrieve a descendant node by its relative coordinates to this node.
         @coord is a list of int. It does not includes this node coord: 0.
         """
-        
-        if len(coords) == 0:
-            return self
-        if len(self.children) == 0:
-            return self
-        if len(coords) == 1:
-            return self.children[coords[0]]
-        else:
-            return self.children[coords[0]][coords[1:]]
+        # Walking stops at leaves, remaining coordinates are ignored.
+        n = self
+        for i in coords:
+            if len(n.children) == 0:
+                break
+            n = n.children[i]
+        return n
 
     def coords(self) -> list:
         """
         Get the coordinate of this node.
         """
         
-        if self.parent is None:
-            return []
-        return self.parent.coords() + [which(self.parent.children, lambda x: x==self)]
+        coords = []
+        n = self
+        while n.parent is not None:
+            coords.append(n.index())
+            n = n.parent
+        coords.reverse()
+        return coords
 
     def swap(self, index: list):
         """
         Reorder a subset children of this node.
         """
-        children = [ self.children[i] for i in index ]
-        for c, i in zip([ self.children[i] for i in index ], sorted(index)):
-            self.children[i] = c
+        children = self.children
+        moved = [ children[i] for i in index ]
+        for c, i in zip(moved, sorted(index)):
+            children[i] = c
 
     def index(self):
         """
@@ -180,45 +241,79 @@ class Tree:
         """
         if self.parent is None:
             return 0
-        return which(self.parent.children, lambda x: x==self)
+        # The last index found is checked before searching parent children,
+        # since children lists are reordered in place.
+        children = self.parent.children
+        i = getattr(self, '_index', 0)
+        if i >= len(children) or children[i] is not self:
+            i = children.index(self)
+            # list.index() matches equal nodes too, if a subclass defines
+            # equality.
+            if children[i] is not self:
+                i = next(j for j, c in enumerate(children) if c is self)
+            self._index = i
+        return i
 
     def root(self):
         """
         Get the root of the Tree containing this node.
         """
         
-        if self.parent is None:
-            return self
-        return self.parent.root()
+        n = self
+        while n.parent is not None:
+            n = n.parent
+        return n
 
     def level(self, i: int) -> list:
         """
         Get all nodes at depth @i from this node.
         """
-        if i == 0:
-            return [ self ]
-        if self.is_leaf():
-            return []
-        return concat([ n.level(i - 1) for n in self.children ])
+        # Replace the frontier by its children, one depth at a time.
+        nodes = [ self ]
+        for _ in range(i):
+            nodes = [ c for n in nodes for c in n.children ]
+        return nodes
+
+    def levels(self) -> list:
+        """
+        Get the lists of nodes at each depth from this node, in one walk.
+        levels()[i] is level(i).
+        """
+        levels = [ [ self ] ]
+        while True:
+            nodes = [ c for n in levels[-1] for c in n.children ]
+            if len(nodes) == 0:
+                return levels
+            levels.append(nodes)
 
     def apply(self, fn=lambda node: node, depth=-1):
         """
-        Apply recursively a function to this node and all its descendants.
+        Apply a function to this node and all its descendants, parents
+        first. Descendants below @depth are skipped if @depth is positive.
         """
-        fn(self)
-        if depth == 0 or self.is_leaf():
-            return
-        for c in self.children:
-            c.apply(fn, depth - 1)
+        nodes = [ (self, depth) ]
+        while len(nodes) > 0:
+            n, d = nodes.pop()
+            fn(n)
+            if d != 0:
+                nodes.extend((c, d - 1) for c in reversed(n.children))
 
     def reduce(self, fn=lambda nodes: nodes[0]):
         """
         Select a leaf by recursive reduction choice.
         """
-        if self.is_leaf():
-            return self
-        else:
-            return fn([n.reduce(fn) for n in self.children])
+        # In post-order, the reductions of a node children are the last
+        # values on the stack.
+        values = []
+        for n in self:
+            arity = len(n.children)
+            if arity == 0:
+                values.append(n)
+            else:
+                value = fn(values[-arity:])
+                del values[-arity:]
+                values.append(value)
+        return values[0]
 
     def select(self, cond=lambda n: True):
         """
@@ -230,17 +325,19 @@ class Tree:
         """
         Return the right-most leaf of the tree.
         """
-        if self.is_leaf():
-            return self
-        return self.children[-1].last_leaf()
+        n = self
+        while len(n.children) > 0:
+            n = n.children[-1]
+        return n
 
     def first_leaf(self):
         """
         Return the left-most leaf of the tree.
         """
-        if self.is_leaf():
-            return self
-        return self.children[0].first_leaf()
+        n = self
+        while len(n.children) > 0:
+            n = n.children[0]
+        return n
 
     def remove(self):
         """
@@ -248,8 +345,10 @@ class Tree:
         to the parent.
         """
         if self.parent is not None:
-            self.parent.children = [ n for n in self.parent.children if n != self ]
-            self.parent.children += self.children
+            # Build a new list: iterators may be walking the current one.
+            children = self.parent.children
+            i = self.index()
+            self.parent.children = children[:i] + children[i+1:] + self.children
         for c in self.children:
             c.parent = self.parent
         return self
@@ -262,10 +361,11 @@ class Tree:
         depth += self.get_depth()
         if depth <= 0:
             return self
-        root = self.root()
-        nodes = [ n for n in root if n.get_depth() == depth ]
-        for n in nodes:            
-            n.remove()
+        # Replace children of nodes above depth by their own children.
+        for p in self.root().level(depth - 1):
+            p.children = list(chain.from_iterable(c.children for c in p.children))
+            for c in p.children:
+                c.parent = p
         return self
     
     def prune(self, cond=lambda n: True):
@@ -277,9 +377,14 @@ class Tree:
         """
 
         eliminated = [n for n in self if cond(n)]
+        # Filter each parent children list once, whatever the number of
+        # children eliminated.
+        parents = {}
         for e in eliminated:
             if e.parent is not None:
-                e.parent.children = [c for c in e.parent.children if c != e]
+                parents.setdefault(id(e.parent), (e.parent, set()))[1].add(id(e))
+        for p, ids in parents.values():
+            p.children = [c for c in p.children if id(c) not in ids]
         return eliminated
 
 class TreeIterator:
@@ -311,39 +416,38 @@ class TreeIterator:
         """
         Iterate through all elements and return the number of elements
         """
-        
-        try:
-            next(self)
-            return self.count(start + 1)
-        except StopIteration:
-            return start
+        for _ in self:
+            start += 1
+        return start
 
     def reset(self):
         """
         Reset iterator without creating a new iterator.
         """
-
-        self.current = self.tree
-        while len(self.current.children) > 0:
-            self.current = self.current.children[0]
+        # Stack of nodes being visited with an iterator on their children
+        # left to visit.
+        self._stack = [ (self.tree, iter(self.tree.children)) ]
 
     def __iter__(self):
         return self
 
     def __next__(self):
-        if self.current is None:
-            raise StopIteration
-        ret = self.current
-        n = self.current.index() + 1
-        if self.current.parent is None or self.current is self.tree:
-            self.current = None
-        elif n == len(self.current.parent.children):
-            self.current = self.current.parent
-        else:
-            self.current = self.current.parent.children[n]
-            while len(self.current.children) > 0:
-                self.current = self.current.children[0]
-        return ret if self.cond(ret) else next(self)
+        stack = self._stack
+        cond = self.cond
+        while len(stack) > 0:
+            node, children = stack[-1]
+            child = next(children, None)
+            if child is not None:
+                stack.append((child, iter(child.children)))
+            else:
+                stack.pop()
+                # A node detached from its parent, e.g by remove(), ends
+                # the walk.
+                if node.parent is None:
+                    stack.clear()
+                if cond(node):
+                    return node
+        raise StopIteration
 
 class ScatterTreeIterator:
     """
@@ -369,8 +473,12 @@ class ScatterTreeIterator:
         self.tree = tree
         self.stop = False
         self.cond = cond
-        for node in tree:
+        self._last_leaf = tree.last_leaf()
+        nodes = [ tree ]
+        while len(nodes) > 0:
+            node = nodes.pop()
             node.visit = -2
+            nodes.extend(node.children)
 
     def __iter__(self):
         return self
@@ -379,28 +487,29 @@ class ScatterTreeIterator:
         """
         Iterate through all elements and return the number of elements
         """
-        
-        try:
-            next(self)
-            return self.count(start + 1)
-        except StopIteration:
-            return start
+        for _ in self:
+            start += 1
+        return start
 
     def _visit_node_(self, node):
-        node.visit = node.visit + 1
-        if node.visit < 0:
-            return node
-        if node.visit < len(node.children):
-            return self._visit_node_(node.children[node.visit])
-        else:
-            node.visit = -1
-            if node == self.tree.last_leaf():
-                raise StopIteration()
-            return self._visit_node_(self.tree)
+        while True:
+            visit = node.visit + 1
+            node.visit = visit
+            if visit < 0:
+                return node
+            if visit < len(node.children):
+                node = node.children[visit]
+            else:
+                node.visit = -1
+                if node is self._last_leaf:
+                    raise StopIteration()
+                node = self.tree
 
     def __next__(self):
         ret = self._visit_node_(self.tree)
-        return ret if self.cond(ret) else next(self)
+        while not self.cond(ret):
+            ret = self._visit_node_(self.tree)
+        return ret
 
 class Trandom(Tree):
     """
@@ -411,18 +520,24 @@ class Trandom(Tree):
         self.gen_children(arity_max, 2, depth_min-1, depth_max-1, rdgen)
 
     def gen_children(self, arity_max, arity_min, depth_min, depth_max, rdgen):
-        if depth_min > 0:
-            children = [ Tree() for i in range(rdgen(arity_min, arity_max)) ]
-            self.connect_children(children)
-            for c in children:
-                c.__class__ = Trandom
-                c.gen_children(arity_max, arity_min, depth_min-1, depth_max, rdgen)
-        elif depth_max > 0:
-            children = [ Tree() for i in range(rdgen(0, arity_max)) ]
-            self.connect_children(children)
+        # Nodes are generated depth first, children from left to right.
+        nodes = [ (self, depth_min, depth_max) ]
+        while len(nodes) > 0:
+            node, depth_min, depth_max = nodes.pop()
+            if depth_min > 0:
+                n = rdgen(arity_min, arity_max)
+                depth_min -= 1
+            elif depth_max > 0:
+                n = rdgen(0, arity_max)
+                depth_max -= 1
+            else:
+                continue
+            children = [ Trandom.__new__(Trandom) for i in range(n) ]
             for c in children:
-                c.__class__ = Trandom
-                c.gen_children(arity_max, arity_min, depth_min, depth_max-1, rdgen)
+                c.parent = node
+                c.children = []
+            node.children.extend(children)
+            nodes.extend((c, depth_min, depth_max) for c in reversed(children))
         
 class Tleaf(Tree):
     """
@@ -441,12 +556,28 @@ class Tleaf(Tree):
 
         if isinstance(arities, int):
             arities = [ arities ] + list(args)
-        if len(arities) > 1:
-            self.connect_children(
-                [Tleaf(arities[1:]) for i in range(arities[0])])
-        elif len(arities) == 1:
-            self.connect_children([Tleaf([]) for i in range(arities[0])])
         self.arities = arities
+        # Build the tree one level at a time. Nodes of a level share the
+        # list of arities below them.
+        nodes = [ self ]
+        for depth, arity in enumerate(arities):
+            below = arities[depth + 1:]
+            level = []
+            for p in nodes:
+                p.children = [ Tleaf._node_(p, below) for i in range(arity) ]
+                level += p.children
+            nodes = level
+
+    @staticmethod
+    def _node_(parent, arities):
+        """
+        Make a Tleaf node without children below @parent.
+        """
+        node = Tleaf.__new__(Tleaf)
+        node.parent = parent
+        node.children = []
+        node.arities = arities
+        return node
 
 __all__ = ['Tree', 'Tleaf', 'Trandom', 'TreeIterator', 'ScatterTreeIterator']
 
@@ -466,10 +597,22 @@ class TestTree(unittest.TestCase):
             for node in tree:
                 self.assertEqual(node.root(), tree)
                 
+    def test_index(self):
+        class Equal(Tree):
+            def __eq__(self, other):
+                return True
+        root = Tree()
+        children = [ Equal(root) for i in range(3) ]
+        self.assertEqual([ c.index() for c in children ], [0, 1, 2])
+        children[1].remove()
+        self.assertEqual(root.children, [ children[0], children[2] ])
+        self.assertIs(root.children[1], children[2])
+
     def test_coords(self):
         for tree in self.trees:
             for node in tree:
                 coords = node.coords()
+                self.assertIs(tree[coords], node)
                 while node.parent is not None:
                     self.assertEqual(coords[-1], node.index())
                     coords = coords[:-1]
@@ -492,12 +635,46 @@ class TestTree(unittest.TestCase):
                 for l in level:
                     self.assertEqual(l.get_depth(), i)
 
+    def test_levels(self):
+        for tree in self.trees:
+            levels = tree.levels()
+            self.assertEqual(len(levels), tree.max_depth() + 1)
+            for i, level in enumerate(levels):
+                self.assertEqual(level, tree.level(i))
+
     def test_reduce(self):
         for tree in self.trees:
             first_leaf = tree.reduce(lambda nodes: nodes[0])
             self.assertTrue(first_leaf.is_leaf())
             self.assertEqual(sum(first_leaf.coords()), 0)
 
+    def test_is_equal(self):
+        self.assertTrue(Tleaf([2, 3]).is_equal(Tleaf([2, 3])))
+        self.assertFalse(Tleaf([2, 3]).is_equal(Tleaf([3, 2])))
+        self.assertFalse(Tleaf([]).is_equal(Tleaf([2, 3])))
+        for tree in self.trees:
+            self.assertTrue(tree.is_equal(tree))
+
+    def test_remove_while_iterating(self):
+        tree = Tree.from_list([[1], [1], [1]])
+        for n in tree:
+            if n.arity() == 1:
+                n.remove()
+        self.assertEqual([ n.arity() for n in tree ], [0, 0, 0, 3])
+
+    def test_str_detached(self):
+        tree = Tleaf([1, 2, 2])
+        child = tree.children[0]
+        # Removing the root detaches its child, still listed as a child.
+        tree.remove()
+        self.assertIsNone(child.parent)
+        self.assertEqual(str(tree), str(child))
+
+    def test_iter_leaves(self):
+        for tree in self.trees:
+            self.assertEqual(list(tree.iter_leaves()),
+                             [ n for n in tree if n.is_leaf() ])
+
     def test_iterator(self):
         for tree in self.trees:
             it = TreeIterator(tree)
@@ -1,40 +1,48 @@
-from functools import reduce
+import math
+from functools import lru_cache
+from itertools import chain
 
 def concat(lists):
     """
     Take nested lists and make it a single level list.
     """
-    return reduce(lambda x, y: x+y, lists, [])
+    return list(chain.from_iterable(lists))
 
 def argmin(l):
     """
     Get index of min element in list
     """
-    return min(zip(l, range(len(l))))[1]
+    return min(range(len(l)), key=l.__getitem__)
 
 def which(l, cond):
     """
     Return index of next element in list l satisfying condition cond.
     """
-    return next((y[0] for y in zip(range(len(l)), l) if cond(y[1])), None)
+    return next((i for i, x in enumerate(l) if cond(x)), None)
 
-def order(l, key=lambda x: x):
+def order(l, key=None):
     """
     Get an index that would reorder list l.
     """
-    return [x[1] for x in sorted(zip(l, range(len(l))), key=lambda x: key(x[0]))]
+    if key is None:
+        return sorted(range(len(l)), key=l.__getitem__)
+    return sorted(range(len(l)), key=lambda i: key(l[i]))
 
 def isindex(l):
     """
     Return True is l contains all integers of range(len(l)) else false.
     """
-    return next((False for i in range(len(l)) if i not in l), True)
+    return set(range(len(l))).issubset(l)
 
+def fenwick(n):
+    """
+    Build a Fenwick tree (binary indexed tree) of n slots all set to 1.
+    """
+    return [0] + [i & -i for i in range(1, n + 1)]
+
+@lru_cache(maxsize=512)
 def factorial(n):
-    r = 1
-    while n > 1:
-        r = r * n
-        n = n - 1
-    return r
+    return math.factorial(n) if n > 1 else 1
     
-__all__ = [ 'unlist', 'argmin', 'which', 'order', 'isindex', 'factorial' ]
+__all__ = [ 'concat', 'argmin', 'which', 'order', 'isindex', 'fenwick',
+            'factorial' ]